@@ -1,153 +1,364 @@
-﻿from flask import Flask, request, jsonify, Response
+﻿from flask import Flask, request, Response
+from flask.json.provider import DefaultJSONProvider
 from datetime import datetime
 from docx import Document
-import re, os, traceback, yagmail
-import threading
+import re, os, io, sys, string, zipfile, smtplib, orjson
+from xml.sax.saxutils import escape as xml_escape
+import threading, atexit, functools, time, queue, hmac
+from concurrent.futures import ThreadPoolExecutor
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Route Flask's jsonify / get_json through orjson.
+
+    Keeps the stdlib provider's behaviour where orjson's defaults differ:
+    non-str dict keys are stringified, sort_keys is honoured, and dates go
+    through self.default (HTTP dates) instead of orjson's ISO format.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 import logging
-app.logger.setLevel(logging.INFO)
+# An unknown LOG_LEVEL would make setLevel raise at import and the worker
+# would never boot; fall back to INFO instead.
+_LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# getLevelName maps a known name to its int (getLevelNamesMapping is 3.11+ only)
+if isinstance(logging.getLevelName(_LOG_LEVEL), int):
+    app.logger.setLevel(_LOG_LEVEL)
+else:
+    app.logger.setLevel(logging.INFO)
+    app.logger.warning("Unknown LOG_LEVEL %r; using INFO", _LOG_LEVEL)
 
 # ----- CONFIG -----
 GMAIL_USER = os.getenv("GMAIL_USER")
 GMAIL_PASS = os.getenv("GMAIL_PASS")
+# Meta webhook verification token; when unset, any subscribe challenge is echoed
+VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
+_VERIFY_TOKEN_B = VERIFY_TOKEN.encode() if VERIFY_TOKEN else None
+WORKERS = int(os.getenv("WORKERS", "4"))
+MAX_PENDING = int(os.getenv("MAX_PENDING", "64"))   # jobs queued, running or awaiting email before we shed load
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))   # seconds per SMTP socket operation
+WARMUP = os.getenv("WARMUP") == "1"   # log in to SMTP and run one parse + doc at boot
+
+# Bounded pool for parse/docx work; the semaphore caps jobs in flight (from
+# submit until the email is sent) so a burst of webhooks gets 503s instead of
+# piling up documents in memory.
+EXECUTOR = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="quote")
+_PENDING = threading.BoundedSemaphore(MAX_PENDING)
+
+# Linear-time (DFA) engine for the long multi-clause patterns; falls back to
+# the stdlib backtracking engine when google-re2 is not installed.
+try:
+    import re2
+    _compile_linear = re2.compile
+except ImportError:
+    re2 = None
+    _compile_linear = re.compile
 
 # Strong regex parser for messages like:
 # "quote 110 for Raju at Raj Pvt Ltd, 500 pcs 3in SS 316L sheets at 25000, hsn 7219, email raju@example.com"
-QUOTE_RE = re.compile(
-    r"""
-    quote\s*(?P<qno>\d+)                              # quote number
-    .*?\bfor\b\s+(?P<name>[A-Za-z][A-Za-z ]{1,60})    # name
-    \s+\bat\b\s+(?P<company>[^,]+)                    # company
-    ,?\s+(?P<qty>\d+)\s*(?P<units>pcs|nos|kgs|kg|mt|ton|piece|pieces)? # quantity + optional units
-    .*?\b(?P<product>ss|stainless|mild|ms|alloy|aluminium|copper|brass|nickel|3in|4in|pipe|sheet|sheets|coil|bar|rod|flange|valve|fitting|316L|304L|310S|duplex|superduplex|sch\s*\d+|sch\d+|[\w\-\s/]+?)\b
-    .*?\bat\s+(?P<rate>\d{2,})                        # rate
-    (?:.*?\bhsn\b\s*(?P<hsn>\d{4,8}))?                # optional hsn
-    .*?\bemail\b\s*(?P<email>[\w.\-\+%]+@[\w.-]+\.[A-Za-z]{2,})  # email
-    """,
-    re.IGNORECASE | re.VERBOSE | re.DOTALL,
+# Written with inline flags and no verbose mode so it compiles under re2 and re alike.
+# Every gap between keywords is a bounded class ([^,]{..}, [^@]{..}) rather than
+# .*?, so a failed match cannot backtrack across the whole message.
+QUOTE_RE = _compile_linear(
+    r"(?i)"
+    r"quote\s*(?P<qno>\d+)"                                   # quote number
+    r"[^,]{0,80}?\bfor\s+(?P<name>[A-Za-z][A-Za-z ]{0,59}?)"   # name
+    r"\s+at\s+(?P<company>[^,]{1,80})"                         # company
+    r",?\s+(?P<qty>\d{1,7})\s*(?P<units>pcs|nos|kgs|kg|mt|ton|piece|pieces)?"  # quantity + optional units
+    r"\s+(?P<product>[^,]{1,120}?)"                            # product
+    r"\s+at\s+(?P<rate>\d{2,})\b"                             # rate
+    r"(?:[^@]{0,80}?\bhsn\s*(?P<hsn>\d{4,8}))?"                # optional hsn
+    r"[^@]{0,80}?\bemail\s*(?P<email>[\w.\-\+%]+@[\w.-]+\.[A-Za-z]{2,})"  # email
 )
 
 def _clean(s: str) -> str:
     return " ".join((s or "").strip().split())
 
-def parse_message(text: str):
-    if not text:
-        return None
-
-    raw = text
-    text = " ".join(text.split())
-    app.logger.info(f"[PARSE] incoming: {raw}")
+# ---------- parse_message helpers & regex (compiled once at import) ----------
+# parse_message lowercases the message once (ASCII only, so offsets line up with
+# the original) and runs every pattern below on that buffer; none needs re.I.
+# Case-sensitive values (name, company, email, product) are sliced back out of
+# the original text by match offsets.
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_WS_RE    = re.compile(r'\s+')
+_EMAIL_RE = re.compile(r'([\w.\-+%]+@[\w.\-]+\.[a-z]{2,})')
+_QNO_RE   = re.compile(r'\bquote\s*(\d{1,10})\b')
+_RATE_RE  = re.compile(r'\b(?:rate|at)\s*([0-9]{3,})\b')
+# allow "5pcs", "5 psc", "5psc", "5 nos" etc
+_QTY_RE   = re.compile(r'\b(\d{1,7})\s*(pcs|psc|nos|pieces?|kgs?|kg|mt|ton|bundle|bndl)?\b')
+_QTY_KW_RE = re.compile(r'\b(quantity|qty)\b\s*(\d{1,7}\s*(?:pcs|psc|nos|pieces?|kgs?|kg|mt|ton|bundle|bndl)?)')
+_HSN_RE   = re.compile(r'\bhsn\s*([0-9]{4,8})\b')
+_LEAD_FILLER_RE = re.compile(r'(customer name is|for|to)\b')
+_TRAIL_RATE_RE = re.compile(r'\b(?:rate|at)\s*(\d+)\b')
+
+_UNITS_MAP = {sys.intern(k): v for k, v in {
+    "piece":"pcs","pieces":"pcs","nos":"pcs","pcs":"pcs","psc":"pcs",
+    "kg":"Kgs","kgs":"Kgs","mt":"MT","ton":"Ton","bundle":"Bundle","bndl":"Bundle"
+}.items()}
+
+# Name patterns: "for NAME", "to NAME", "customer name is NAME"
+_NAME_PATTERNS = tuple(re.compile(p) for p in (
+    r'\bfor\s+([a-z][\w .\'\-]{1,60})\b',
+    r'\bto\s+([a-z][\w .\'\-]{1,60})\b',
+    r'\bcustomer\s+name\s+is\s+([a-z][\w .\'\-]{1,60})\b',
+))
+
+# Company optional: "at COMPANY" if it exists
+_COMPANY_RE = re.compile(r'\bat\s+([^,]+)')
+
+# compact trader shorthand: "quote 500 pcs 3in ss pipe @600 hsn 7304 to raju@x.com"
+# re2 has no lookahead, so _shorthand_product_ok rejects matches whose product
+# ran over keywords or another quantity ("quote 110 for Raju at ... 500 pcs").
+_SHORTHAND_RE = _compile_linear(
+    r"quote\s+(?P<qty>\d{1,7})\s*(?P<units>pcs|psc|nos|pieces?|kgs?|kg|mt|ton|bundle|bndl)?"
+    r"\s+(?P<product>[^@,]{1,120}?)\s*@\s*(?P<rate>\d+(?:\.\d+)?)"
+    r"(?:\s+hsn\s*(?P<hsn>\d{4,8}))?"
+    r"\s+to\s+(?P<email>[\w.\-+%]+@[\w.\-]+\.[a-z]{2,})"
+)
 
-    import re
+# Structured patterns, tried before the heuristic fallback
+_STRUCTURED_PATS = (
+    _compile_linear(
+        r"quote\s*(?P<qno>\d+)[^,]{0,80}?\b(?:for|to)\s+(?P<name>[a-z][^,]{0,59}?)"
+        r"(?:\s+at\s+(?P<company>[^,]{1,80}?))?"
+        r"\s*,?\s*(?:(?:qty|quantity)\s*)?\b(?P<qty>\d{1,7})\s*(?P<units>pcs|psc|nos|pieces?|kgs?|kg|mt|ton|bundle|bndl)?"
+        r"\s+(?P<product>[^,]{1,120}?)\s+(?:rate|at)\s+(?P<rate>\d{3,})\b"
+        r"(?:[^@]{0,80}?\bhsn\s*(?P<hsn>\d{4,8}))?"
+        r"[^@]{0,80}?\bemail\s*(?P<email>[\w.\-+%]+@[\w.\-]+\.[a-z]{2,})"
+    ),
+    _SHORTHAND_RE,
+)
 
-    # ---------- helpers & regex ----------
-    EMAIL_RE = re.compile(r'([\w.\-+%]+@[\w.\-]+\.[A-Za-z]{2,})')
-    QNO_RE   = re.compile(r'\bquote\s*(\d{1,10})\b', re.I)
-    RATE_RE  = re.compile(r'\b(?:rate|at)\s*([0-9]{3,})\b', re.I)
-    # allow "5pcs", "5 psc", "5psc", "5 nos" etc
-    QTY_RE   = re.compile(r'\b(\d{1,7})\s*(pcs|psc|nos|pieces?|kgs?|kg|mt|ton|bundle|bndl)?\b', re.I)
-    HSN_RE   = re.compile(r'\bhsn\s*([0-9]{4,8})\b', re.I)
+def _norm_units(u):
+    return _UNITS_MAP.get(u.lower(), "pcs") if u else "pcs"
+
+# Product-segment anchors (earliest wins) and name tags for the heuristic fallback
+_ANCHOR_RE = re.compile(r'\b(quantity|qty|rate|hsn|email)\b')
+_NAME_TAGS = (" for ", " to ", " customer name is ")
+
+# Words that end a free-text phrase (name / company) in the token walker
+_STOP_WORDS = frozenset(("at", "for", "to", "qty", "quantity", "rate", "hsn", "email"))
+_PUNCT = ",.;:"
+# Numbers right after these are the quote number, rate or hsn, never the quantity
+_QTY_SLOT_SKIP = frozenset(("quote", "at", "rate", "hsn"))
+
+def _phrase(words, lows, j):
+    """Collect words from index j until a keyword, number, email or trailing comma."""
+    out = []
+    n = len(words)
+    while j < n:
+        k = lows[j].strip(_PUNCT)
+        if not k or k in _STOP_WORDS or k[0].isdigit() or "@" in k:
+            break
+        w = words[j]
+        out.append(w.rstrip(","))
+        j += 1
+        if w.endswith(","):
+            break
+    return " ".join(out), j
 
-    units_map = {
-        "piece":"pcs","pieces":"pcs","nos":"pcs","pcs":"pcs","psc":"pcs",
-        "kg":"Kgs","kgs":"Kgs","mt":"MT","ton":"Ton","bundle":"Bundle","bndl":"Bundle"
+def _take_qty(lows, j):
+    """Read "500", "500 pcs" or "500pcs" at index j -> (qty, unit, next_j) or None."""
+    tok = lows[j].strip(_PUNCT)
+    digits = tok[:len(tok) - len(tok.lstrip("0123456789"))]
+    if not digits or len(digits) > 7:
+        return None
+    rest = tok[len(digits):]
+    if rest:
+        return (digits, rest, j + 1) if rest in _UNITS_MAP else None
+    nxt = lows[j + 1].strip(_PUNCT) if j + 1 < len(lows) else ""
+    if nxt in _UNITS_MAP:
+        return digits, nxt, j + 2
+    return digits, "", j + 1
+
+def _shorthand_product_ok(low_product: str) -> bool:
+    """False if a shorthand product contains a keyword or a number with a unit."""
+    toks = low_product.split()
+    for j, t in enumerate(toks):
+        t = t.strip(_PUNCT)
+        if t in _STOP_WORDS or t == "quote":
+            return False
+        q = _take_qty(toks, j)
+        if q and q[1]:
+            return False
+    return True
+
+def _tokenize_parse(text: str, low: str):
+    """One left-to-right pass over the message tokens, dispatching on keywords.
+
+    Returns the same ctx dict as parse_message, or None if name/qty/rate/email
+    could not all be found (the caller then falls back to the regex heuristics).
+    """
+    words = text.split()
+    lows = low.split()
+    n = len(words)
+    em = _EMAIL_RE.search(low)
+    # With an explicit "qty N", or a number with a unit ("10 pcs") anywhere
+    # outside the quote/rate/hsn slots, bare numbers belong to the product
+    # ("ss 304 pipe", "2 inch") rather than being taken as the quantity.
+    qty_kw = any(lows[j].strip(_PUNCT) in ("qty", "quantity") and lows[j + 1][:1].isdigit()
+                 for j in range(n - 1))
+    unit_qty = any(lows[j][:1].isdigit() and (q := _take_qty(lows, j)) and q[1]
+                   and (j == 0 or lows[j - 1].strip(_PUNCT) not in _QTY_SLOT_SKIP)
+                   for j in range(n))
+
+    qno = name = company = qty = unit = rate = hsn = ""
+    product = []
+    product_done = False
+    i = 0
+    while i < n:
+        k = lows[i].strip(_PUNCT)
+        nxt = lows[i + 1].strip(_PUNCT) if i + 1 < n else ""
+
+        if k == "quote" and nxt.isdigit() and not qno:
+            qno = nxt
+            i += 2
+        elif k in ("for", "to") and not name and nxt[:1].isalpha():
+            name, i = _phrase(words, lows, i + 1)
+        elif k == "customer" and not name and lows[i + 1:i + 3] == ["name", "is"]:
+            name, i = _phrase(words, lows, i + 3)
+        elif k in ("at", "rate") and nxt.isdigit() and len(nxt) >= 3:
+            rate = rate or nxt
+            product_done = product_done or bool(product)
+            i += 2
+        elif k == "at" and not company and nxt[:1].isalpha():
+            company, i = _phrase(words, lows, i + 1)
+        elif k in ("qty", "quantity") and nxt[:1].isdigit() and _take_qty(lows, i + 1):
+            qty, unit, i = _take_qty(lows, i + 1)
+        elif k == "hsn" and nxt.isdigit() and 4 <= len(nxt) <= 8:
+            hsn = hsn or nxt
+            product_done = product_done or bool(product)
+            i += 2
+        elif k == "email" or "@" in k:
+            product_done = product_done or bool(product)
+            i += 1
+        else:
+            q = None if qty or qty_kw or not k[:1].isdigit() else _take_qty(lows, i)
+            if q and (q[1] or not unit_qty):
+                qty, unit, i = q
+                continue
+            if k == "product" and not product:
+                i += 1   # "product copper rod": the label is not part of the value
+                continue
+            if name and not product_done and k:
+                product.append(words[i].rstrip(","))
+            i += 1
+
+    email = text[em.start(1):em.end(1)] if em else ""
+    if not (name and qty and rate and email):
+        return None
+    return {
+        "qno": qno,
+        "name": name.title(),
+        "company": company,
+        "qty": qty,
+        "units": _UNITS_MAP.get(unit, "pcs"),   # unit was sliced from the lowercased buffer
+        "product": " ".join(product)[:120],
+        "rate": rate,
+        "hsn": hsn,
+        "email": email,
     }
 
-    # Name patterns: "for NAME", "to NAME", "customer name is NAME"
-    NAME_PATTERNS = [
-        re.compile(r'\bfor\s+([A-Za-z][\w .\'\-]{1,60})\b', re.I),
-        re.compile(r'\bto\s+([A-Za-z][\w .\'\-]{1,60})\b', re.I),
-        re.compile(r'\bcustomer\s+name\s+is\s+([A-Za-z][\w .\'\-]{1,60})\b', re.I),
-    ]
+def parse_message(text: str):
+    if not text:
+        return None
 
-    # Company optional: "at COMPANY" if it exists
-    COMPANY_RE = re.compile(r'\bat\s+([^,]+)', re.I)
+    app.logger.info("[PARSE] incoming: %s", text)
+    # Resends and Meta redeliveries repeat the exact message, so results are
+    # cached on the whitespace-canonical text; callers get their own copy.
+    ctx = _parse_canonical(_WS_RE.sub(" ", text.strip()))
+    return dict(ctx) if ctx else None
+
+@functools.lru_cache(maxsize=1024)
+def _parse_canonical(text: str):
+    low = text.translate(_ASCII_LOWER)
 
     # ---------- try structured patterns first ----------
-    patterns = [
-        re.compile(
-            r"""quote\s*(?P<qno>\d+).*?\b(?:for|to)\b\s+(?P<name>[^,]+?)
-                (?:\s+\bat\b\s+(?P<company>[^,]+))?
-                .*?(?P<qty>\d{1,7})\s*(?P<units>pcs|psc|nos|pieces?|kgs?|kg|mt|ton|bundle|bndl)?
-                \s+(?P<product>.+?)\s+\b(?:rate|at)\b\s+(?P<rate>\d{3,})
-                (?:.*?\bhsn\b\s*(?P<hsn>\d{4,8}))?
-                .*?\bemail\b\s*(?P<email>[\w.\-+%]+@[\w.\-]+\.[A-Za-z]{2,})
-            """, re.I | re.X),
-    ]
-
-    def norm_units(u):
-        u = (u or "").lower()
-        return units_map.get(u, "pcs")
-
-    for pat in patterns:
-        m = pat.search(text)
+    for pat in _STRUCTURED_PATS:
+        m = pat.search(low)
+        if m and pat is _SHORTHAND_RE and not _shorthand_product_ok(m.group("product")):
+            continue
         if m:
-            d = {k: _clean(v) if isinstance(v, str) else v for k, v in m.groupdict().items()}
+            d = {}
+            for k, g in pat.groupindex.items():
+                s, e = m.span(g)
+                d[k] = _clean(text[s:e]) if s != -1 else ""
             return {
                 "qno": d.get("qno",""),
-                "name": (d.get("name","") or "").title(),
+                "name": (d.get("name","") or "").title(),   # blank for the shorthand
                 "company": d.get("company",""),
                 "qty": d.get("qty",""),
-                "units": norm_units(d.get("units")) if d.get("qty") else "",
+                "units": _norm_units(d.get("units")) if d.get("qty") else "",
                 "product": (d.get("product","") or "")[:120],
                 "rate": d.get("rate",""),
                 "hsn": d.get("hsn",""),
                 "email": d.get("email",""),
             }
 
+    # ---------- single-pass token walk ----------
+    ctx = _tokenize_parse(text, low)
+    if ctx:
+        return ctx
+
     # ---------- heuristic fallback ----------
-    qno    = (QNO_RE.search(text) or [None, ""])[1]
-    email  = (EMAIL_RE.search(text) or [None, ""])[1]
-    rate   = (RATE_RE.search(text) or [None, ""])[1]
+    qno    = (_QNO_RE.search(low) or [None, ""])[1]
+    me     = _EMAIL_RE.search(low)
+    email  = text[me.start(1):me.end(1)] if me else ""
+    rate   = (_RATE_RE.search(low) or [None, ""])[1]
 
     qtym   = None
     # prefer the 'quantity/qty' segment if present; else any number+unit
-    qty_kw = re.search(r'\b(quantity|qty)\b\s*(\d{1,7}\s*(?:pcs|psc|nos|pieces?|kgs?|kg|mt|ton|bundle|bndl)?)', text, re.I)
+    qty_kw = _QTY_KW_RE.search(low)
     if qty_kw:
-        qtym = QTY_RE.search(qty_kw.group(0))
+        qtym = _QTY_RE.search(low, qty_kw.start(), qty_kw.end())
     if not qtym:
-        qtym = QTY_RE.search(text)
+        qtym = _QTY_RE.search(low)
 
     qty    = qtym.group(1) if qtym else ""
     uraw   = qtym.group(2) if (qtym and qtym.lastindex and qtym.lastindex >= 2) else ""
-    units  = norm_units(uraw) if qty else ""
-    hsn    = (HSN_RE.search(text) or [None, ""])[1]
+    units  = _norm_units(uraw) if qty else ""
+    hsn    = (_HSN_RE.search(low) or [None, ""])[1]
 
     # name: try multiple patterns
     name = ""
-    for np in NAME_PATTERNS:
-        mm = np.search(text)
+    for np in _NAME_PATTERNS:
+        mm = np.search(low)
         if mm:
-            name = _clean(mm.group(1))
+            name = _clean(text[mm.start(1):mm.end(1)])
             break
 
     # company (optional)
     company = ""
-    mc = COMPANY_RE.search(text)
+    mc = _COMPANY_RE.search(low)
     if mc:
-        company = _clean(mc.group(1))
+        company = _clean(text[mc.start(1):mc.end(1)])
 
     # product: take the segment between the name and the first of (quantity|qty|rate|hsn|email)
     product = ""
-    anchors = []
-    for a in [" quantity ", " qty ", " rate ", " hsn ", " email "]:
-        p = text.lower().find(a)
-        if p != -1:
-            anchors.append(p)
-    cut_to = min(anchors) if anchors else -1
+    ma = _ANCHOR_RE.search(low)
+    cut_to = ma.start() if ma else -1
 
     # starting point: after name, or after "to/for/customer name is"
     start = -1
     if name:
         # find where that name appears and begin after its occurrence
-        for tag in [" for ", " to ", " customer name is "]:
-            pos = text.lower().find(tag)
+        name_low = name.translate(_ASCII_LOWER)
+        for tag in _NAME_TAGS:
+            pos = low.find(tag)
             if pos != -1:
                 pos2 = pos + len(tag)
                 # next substring begins with the name
-                name_pos = text.lower().find(name.lower(), pos2)
+                name_pos = low.find(name_low, pos2)
                 if name_pos != -1:
                     start = name_pos + len(name)
                     break
@@ -162,15 +373,20 @@ def parse_message(text: str):
     # strip commas and filler words
     candidate = candidate.strip(" ,.-")
     # if candidate begins with delimiters like 'customer name is', trim again
-    candidate = re.sub(r'^(customer name is|for|to)\b', '', candidate, flags=re.I).strip(" ,.-")
+    mf = _LEAD_FILLER_RE.match(candidate.translate(_ASCII_LOWER))
+    if mf:
+        candidate = candidate[mf.end():].strip(" ,.-")
 
     # remove any trailing 'at <rate>' part if present
     if rate:
-        candidate = re.sub(fr'\b(?:rate|at)\s*{re.escape(rate)}\b.*$', '', candidate, flags=re.I).strip(" ,.-")
+        for mr in _TRAIL_RATE_RE.finditer(candidate.translate(_ASCII_LOWER)):
+            if mr.group(1) == rate:
+                candidate = candidate[:mr.start()].strip(" ,.-")
+                break
 
     # If it still looks empty but we had a "quantity ...", try the text between the start of the line and "quantity"
     if not candidate and qty_kw:
-        head = text[: text.lower().find(qty_kw.group(1).lower())]
+        head = text[: qty_kw.start(1)]
         candidate = head.strip(" ,.-")
 
     product = candidate[:120]
@@ -190,116 +406,312 @@ def parse_message(text: str):
     # Only require name, qty, rate, email; company is optional
     required = ["name", "qty", "rate", "email"]
     if any(not ctx[k] for k in required):
-        app.logger.warning(f"[PARSE] fallback incomplete -> {ctx}")
+        app.logger.warning("[PARSE] fallback incomplete -> %s", ctx)
         return None
 
     return ctx
 
-def create_doc(ctx:dict) -> str:
+# ----- DOCX template -----
+# The quotation layout is fixed, so python-docx renders it once per variant
+# (with / without HSN) using sentinel values. create_doc then only
+# substitutes the fields into word/document.xml and re-zips the other parts as-is.
+_DOC_XML = "word/document.xml"
+_DOC_FIELDS = ("qno", "date", "name", "company", "product", "qty", "units", "rate", "hsn", "email")
+
+def _render_doc(ctx:dict, with_hsn:bool) -> Document:
     doc = Document()
     doc.add_heading(f'Quotation #{ctx["qno"]}', level=1)
-    doc.add_paragraph(f'Date: {datetime.now().strftime("%d-%b-%Y")}')
+    doc.add_paragraph(f'Date: {ctx["date"]}')
     doc.add_paragraph(f'Customer: {ctx["name"]}')
     doc.add_paragraph(f'Company: {ctx["company"]}')
     doc.add_paragraph(f'Product: {ctx["product"]}')
     doc.add_paragraph(f'Quantity: {ctx["qty"]} {ctx["units"]}')
     doc.add_paragraph(f'Rate: {ctx["rate"]}')
-    if ctx.get("hsn"):
+    if with_hsn:
         doc.add_paragraph(f'HSN: {ctx["hsn"]}')
     doc.add_paragraph(f'Email: {ctx["email"]}')
-    fname = f'Quotation_{ctx["name"].replace(" ","_")}_{datetime.now().date()}.docx'
-    doc.save(fname)
-    return fname
-
-def send_email(attachment_path:str, to_email:str):
+    return doc
+
+def _build_doc_template(with_hsn:bool):
+    """Return (zip of every static part, document.xml date_time, document.xml format template)."""
+    buf = io.BytesIO()
+    _render_doc({k: f"@@{k}@@" for k in _DOC_FIELDS}, with_hsn).save(buf)
+    static = io.BytesIO()
+    with zipfile.ZipFile(buf) as z, zipfile.ZipFile(static, "w") as out:
+        for info in z.infolist():
+            if info.filename == _DOC_XML:
+                doc_date = info.date_time
+            else:
+                out.writestr(info, z.read(info))
+        xml = z.read(_DOC_XML).decode("utf-8")
+    xml = xml.replace("{", "{{").replace("}", "}}")
+    for k in _DOC_FIELDS:
+        xml = xml.replace(f"@@{k}@@", "{%s}" % k)
+    return static.getvalue(), doc_date, xml
+
+_DOC_TMPL = {False: _build_doc_template(False), True: _build_doc_template(True)}
+
+@functools.lru_cache(maxsize=2)
+def _today_str(epoch_sec:int) -> tuple[str, str]:
+    """(display date, ISO date) for the doc body and filename; keyed on whole seconds."""
+    now = datetime.fromtimestamp(epoch_sec)
+    return now.strftime("%d-%b-%Y"), now.date().isoformat()
+
+@functools.lru_cache(maxsize=128)
+def _zip_doc(with_hsn:bool, values:tuple) -> bytes:
+    # values are the escaped _DOC_FIELDS in order; a resent quote on the same
+    # day hits the cache and skips the zip/deflate work entirely.
+    static, doc_date, xml = _DOC_TMPL[with_hsn]
+    body = xml.format_map(dict(zip(_DOC_FIELDS, values)))
+    # The styles/fonts parts are compressed once at import; only document.xml
+    # is deflated per quote, appended to a copy of the prebuilt archive.
+    # Only the immutable date_time is shared; writestr mutates its ZipInfo
+    # (offsets, CRC, sizes) and workers run this concurrently, so each call
+    # builds its own.
+    info = zipfile.ZipInfo(_DOC_XML, date_time=doc_date)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    buf = io.BytesIO(static)
+    with zipfile.ZipFile(buf, "a") as z:
+        z.writestr(info, body)
+    return buf.getvalue()
+
+def create_doc(ctx:dict) -> tuple[bytes, str]:
+    """Render the quotation in memory; returns (docx bytes, attachment filename)."""
+    date, iso_date = _today_str(int(time.time()))
+    values = tuple(date if k == "date" else xml_escape(str(ctx.get(k, ""))) for k in _DOC_FIELDS)
+    # shorthand quotes carry no customer name
+    who = ctx["name"].replace(" ", "_") or "Customer"
+    fname = f'Quotation_{who}_{iso_date}.docx'
+    return _zip_doc(bool(ctx.get("hsn")), values), fname
+
+def _named_buffer(data:bytes, filename:str) -> io.BytesIO:
+    # yagmail attaches file objects under their .name, so no temp file is needed
+    buf = io.BytesIO(data)
+    buf.name = filename
+    return buf
+
+# ----- SMTP session reuse -----
+# One logged-in SMTP connection, kept open across sends so each quote skips the
+# TCP + TLS + AUTH handshake. yagmail's send() logs in again on every call (and
+# leaks the old socket), so it is only used to log in and build the MIME message;
+# the send itself goes straight to the smtplib connection. Only the email
+# flusher thread sends, so the session needs no lock.
+_SMTP = None
+
+def _drop_smtp():
+    global _SMTP
+    yag, _SMTP = _SMTP, None
+    if yag is not None:
+        try:
+            yag.close()   # QUITs the connection
+        except Exception:
+            pass
+
+def _get_smtp():
+    global _SMTP
+    if _SMTP is None:
+        # Imported on first send: yagmail pulls in ~45 ms of modules that a
+        # worker answering only verification/status webhooks never needs.
+        import yagmail
+        # timeout goes through to smtplib; without it a hung Gmail connection
+        # would stall the only sender, and every _PENDING slot, forever.
+        yag = yagmail.SMTP(GMAIL_USER, GMAIL_PASS, timeout=SMTP_TIMEOUT)
+        yag.login()
+        _SMTP = yag
+    return _SMTP
+
+def send_email(attachment:bytes, filename:str, to_email:str):
     if not GMAIL_USER or not GMAIL_PASS:
         app.logger.error("GMAIL_USER/GMAIL_PASS missing; skipping email send.")
         return False
     try:
-        yag = yagmail.SMTP(GMAIL_USER, GMAIL_PASS)
-        yag.send(
+        yag = _get_smtp()
+        recipients, msg = yag.prepare_send(
             to=to_email,
             subject="Quotation from Nivee Metal Products Pvt. Ltd.",
             contents="Please find the attached quotation.",
-            attachments=attachment_path,
+            attachments=_named_buffer(attachment, filename),
         )
+        try:
+            yag.smtp.sendmail(yag.user, recipients, msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # Gmail closes idle sessions; log in again once and resend.
+            _drop_smtp()
+            yag = _get_smtp()
+            yag.smtp.sendmail(yag.user, recipients, msg)
         return True
+    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+        # The server rejected this message; the session itself is still good.
+        app.logger.error("Email to %s rejected: %s", to_email, e)
+        return False
     except Exception as e:
-        app.logger.exception(f"Email send failed: {e}")
+        app.logger.exception("Email send failed: %s", e)
+        _drop_smtp()
         return False
 
+# ----- Outgoing email sender -----
+# Workers only enqueue (docx bytes, filename, recipient); a single sender thread
+# sends them in arrival order over the one persistent SMTP session. A job keeps
+# its _PENDING slot until its email has been sent, so a slow SMTP server backs up
+# into 503s rather than into an unbounded pile of docx bytes here.
+_EMAIL_Q = queue.Queue()
+_EMAIL_STOP = object()
+
+def _email_flusher():
+    if WARMUP and GMAIL_USER and GMAIL_PASS:
+        # _get_smtp logs in (yagmail alone would connect lazily on first send),
+        # and the first real send reuses this connection.
+        try:
+            _get_smtp()
+            app.logger.info("[MAIL] SMTP warmup: logged in")
+        except Exception as e:
+            app.logger.warning("[MAIL] SMTP warmup failed: %s", e)
+    while True:
+        item = _EMAIL_Q.get()
+        if item is _EMAIL_STOP:
+            break
+        data, fname, to_email = item
+        try:
+            ok = send_email(data, fname, to_email)
+            app.logger.info("[MAIL] emailed=%s to=%s file=%s", ok, to_email, fname)
+        finally:
+            _PENDING.release()
+
+_EMAIL_THREAD = threading.Thread(target=_email_flusher, name="email-flusher", daemon=True)
+_EMAIL_THREAD.start()
+
+def _shutdown():
+    """atexit: let queued jobs finish, flush pending emails, then close the SMTP session."""
+    EXECUTOR.shutdown(wait=True)
+    _EMAIL_Q.put(_EMAIL_STOP)
+    _EMAIL_THREAD.join(timeout=60)
+    _drop_smtp()
+
+atexit.register(_shutdown)
 
 def _background_worker(text: str):
-    """Background worker: parse, create doc, send email. Runs in a daemon thread."""
+    """Background worker: parse, create doc, queue the email. Runs on EXECUTOR.
+
+    Owns one _PENDING slot; it passes to the email flusher with the queued
+    email, and is released here on every other path.
+    """
+    queued = False
     try:
-        app.logger.info(f"[BG] start processing: {text}")
+        app.logger.info("[BG] start processing: %s", text)
         ctx = parse_message(text)
         if not ctx:
             app.logger.warning("[BG] parse failed; skipping")
             return
-        file_path = create_doc(ctx)
-        ok = send_email(file_path, ctx.get("email"))
-        app.logger.info(f"[BG] done: emailed={ok} file={file_path}")
+        data, fname = create_doc(ctx)
+        _EMAIL_Q.put((data, fname, ctx.get("email")))
+        queued = True
+        app.logger.info("[BG] done: email queued file=%s", fname)
     except Exception as e:
-        app.logger.exception(f"Exception in background worker: {e}")
+        app.logger.exception("Exception in background worker: %s", e)
+    finally:
+        if not queued:
+            _PENDING.release()
+
+def _warmup():
+    """Exercise the parse and docx paths once so the first real quote doesn't pay for it."""
+    ctx = parse_message("quote 1 for Warmup at Warmup Ltd, 1 pcs ss pipe rate 100 email warmup@example.com")
+    create_doc(ctx)
+
+if WARMUP:
+    _warmup()
+
+def _submit_background(text: str) -> bool:
+    """Queue text for _background_worker; False when MAX_PENDING jobs are already in flight."""
+    if not _PENDING.acquire(blocking=False):
+        return False
+    try:
+        EXECUTOR.submit(_background_worker, text)
+    except Exception:
+        _PENDING.release()
+        raise
+    return True
 
 def extract_text_from_meta(payload:dict) -> str | None:
+    # Plain .get() descent; status callbacks fall through to None. Malformed
+    # payloads (a string or dict where a list/dict belongs) would raise, and
+    # the webhook has no handler-wide try, so they are caught here.
     try:
-        entry = payload.get("entry", [])[0]
-        change = entry.get("changes", [])[0]
-        value = change.get("value", {})
-        msgs = value.get("messages", [])
+        entry = (payload.get("entry") or [{}])[0]
+        change = (entry.get("changes") or [{}])[0]
+        value = change.get("value") or {}
+        msgs = value.get("messages")
         if not msgs:
             return None
         msg = msgs[0]
         if msg.get("type") == "text":
-            return msg["text"]["body"]
-        return None
-    except Exception:
-        return None
+            body = (msg.get("text") or {}).get("body")
+            return body if isinstance(body, str) else None
+    except (AttributeError, IndexError, KeyError, TypeError):
+        pass
+    return None
+
+# Fixed reply bodies, serialized once. A fresh Response wraps them per request:
+# Flask and after_request hooks mutate response headers, so sharing one object
+# across threads is not safe.
+_IGNORED_JSON = orjson.dumps({"status": "ignored"})
+_ERROR_LOGGED_JSON = orjson.dumps({"status": "error_logged"})
+
+def _json_response(body:bytes, status:int=200) -> Response:
+    return Response(body, status=status, mimetype="application/json")
 
 @app.route("/webhook", methods=["GET", "POST"])
 def webhook():
+    if request.method == "GET":
+        # Support initial verification if you use this endpoint for Meta verification
+        hub_mode = request.args.get("hub.mode")
+        hub_challenge = request.args.get("hub.challenge")
+        hub_verify_token = request.args.get("hub.verify_token")
+        if hub_mode == "subscribe" and hub_challenge:
+            if _VERIFY_TOKEN_B is not None and not hmac.compare_digest(
+                    (hub_verify_token or "").encode(), _VERIFY_TOKEN_B):
+                return Response("Forbidden", status=403)
+            return Response(hub_challenge, status=200)
+        return Response("OK", status=200)
+
+    # POST: validate, queue, ack. Parsing, docx and email all run on EXECUTOR
+    # (which logs its own failures), so Meta gets its answer before any of it.
+    raw = request.get_data(cache=False)
+    # Status callbacks (sent/delivered/read) outnumber real messages; neither
+    # a Meta "messages" array nor a tester "message" key means nothing to do.
+    if b'"messages"' not in raw and b'"message"' not in raw:
+        return _json_response(_IGNORED_JSON)
     try:
-        if request.method == "GET":
-            # Support initial verification if you use this endpoint for Meta verification
-            hub_mode = request.args.get("hub.mode")
-            hub_challenge = request.args.get("hub.challenge")
-            hub_verify_token = request.args.get("hub.verify_token")
-            # Optional: compare to your env VERIFY_TOKEN
-            if hub_mode == "subscribe" and hub_challenge:
-                return Response(hub_challenge, status=200)
-            return Response("OK", status=200)
-
-        # POST
-        body = request.get_json(silent=True) or {}
-        # Accept both tester JSON and Meta payload
-        app.logger.info(f"[WEBHOOK] body: {body}")
-        text = body.get("message") or extract_text_from_meta(body)
-        if not text:
-            app.logger.info("Webhook received but no parsable text message; returning 200.")
-            return jsonify({"status": "ignored"}), 200
-
-        # Immediately acknowledge to WhatsApp / Meta to avoid retries
-        try:
-            thread = threading.Thread(target=_background_worker, args=(text,), daemon=True)
-            thread.start()
-            app.logger.info("[WEBHOOK] background worker started")
-        except Exception as e:
-            app.logger.exception(f"Failed to start background worker: {e}")
-
-    # Return 200 "ok" immediately to acknowledge WhatsApp/Meta and avoid retries
-    return Response("ok", status=200)
+        body = orjson.loads(raw) if raw else {}
+    except orjson.JSONDecodeError:
+        body = {}
+    if not isinstance(body, dict):
+        body = {}
+    # Accept both tester JSON and Meta payload
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info("[WEBHOOK] body: %s", body)
+    text = body.get("message") or extract_text_from_meta(body)
+    if not text or not isinstance(text, str):
+        app.logger.info("Webhook received but no parsable text message; returning 200.")
+        return _json_response(_IGNORED_JSON)
 
+    try:
+        queued = _submit_background(text)
     except Exception as e:
-        app.logger.error("Exception in /webhook: %s\n%s", e, traceback.format_exc())
-        # Always 200 for Meta to avoid retry storms; log the error
-        return jsonify({"status": "error_logged"}), 200
+        app.logger.exception("Failed to queue background job: %s", e)
+        # Always 2xx for Meta to avoid retry storms; log the error
+        return _json_response(_ERROR_LOGGED_JSON)
+    if not queued:
+        app.logger.warning("[WEBHOOK] worker queue full; shedding request")
+        return Response("busy", status=503)
+
+    app.logger.info("[WEBHOOK] background job queued")
+    return "", 202
 
 @app.route("/")
 def health():
     return "Quotation bot is running (regex-only)."
 
+# Local development only; production runs under gunicorn gthread workers (see Procfile).
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "10000"))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,68 @@
+import pytest
+
+from app import parse_message
+
+FULL = ("quote 110 for Raju at Raj Pvt Ltd, 500 pcs 3in SS 316L sheets at 25000, "
+        "hsn 7219, email raju@example.com")
+
+
+def test_structured_message():
+    assert parse_message(FULL) == {
+        "qno": "110", "name": "Raju", "company": "Raj Pvt Ltd", "qty": "500",
+        "units": "pcs", "product": "3in SS 316L sheets", "rate": "25000",
+        "hsn": "7219", "email": "raju@example.com",
+    }
+
+
+def test_structured_message_without_optional_groups():
+    ctx = parse_message("quote 7 for Raju, 500 pcs ss pipe rate 2500 email raju@x.com")
+    assert ctx["company"] == "" and ctx["hsn"] == ""
+    assert (ctx["qty"], ctx["product"], ctx["rate"]) == ("500", "ss pipe", "2500")
+
+
+def test_values_keep_their_case():
+    ctx = parse_message("QUOTE 4 FOR Asha Rao AT Rao Metals, 12 KG Brass Rod RATE 450 EMAIL Asha@Rao.in")
+    assert ctx["company"] == "Rao Metals"
+    assert ctx["product"] == "Brass Rod"
+    assert ctx["units"] == "Kgs"
+    assert ctx["email"] == "Asha@Rao.in"
+
+
+def test_shorthand():
+    ctx = parse_message("quote 500 pcs 3in SS pipe @600 hsn 7304 to raju@x.com")
+    assert ctx == {
+        "qno": "", "name": "", "company": "", "qty": "500", "units": "pcs",
+        "product": "3in SS pipe", "rate": "600", "hsn": "7304", "email": "raju@x.com",
+    }
+
+
+def test_shorthand_does_not_swallow_a_numbered_quote():
+    # "110" is the quote number, not a quantity; the message is rejected
+    # rather than emailed with qty=110 and the whole tail as the product.
+    assert parse_message("quote 110 for Raju at Raj Pvt Ltd 500 pcs ss pipe @600 to raju@x.com") is None
+
+
+@pytest.mark.parametrize("text, qty, units, product", [
+    ("quote 5 for Raj, SS 304 pipe 10 pcs rate 500 email raj@x.com",
+     "10", "pcs", "SS 304 pipe"),
+    ("quote 55 for ABC, ss pipe 2 inch, 10 pcs rate 600 email abc@x.com",
+     "10", "pcs", "ss pipe 2 inch"),
+    ("quote 12 for Amit Shah at Shah Steels, product ss pipe 2 inch, qty 50 pcs, rate 1200, email a@b.com",
+     "50", "pcs", "ss pipe 2 inch"),
+    ("quote 9 for Dev Rao, product copper rod, 20 kg rate 900 email dev@x.com",
+     "20", "Kgs", "copper rod"),
+])
+def test_token_walker_quantity_and_product(text, qty, units, product):
+    ctx = parse_message(text)
+    assert (ctx["qty"], ctx["units"], ctx["product"]) == (qty, units, product)
+
+
+def test_missing_required_field():
+    assert parse_message("quote 5 for Raj, ss pipe 10 pcs email raj@x.com") is None
+    assert parse_message("") is None
+
+
+def test_cached_result_is_not_shared():
+    ctx = parse_message(FULL)
+    ctx["name"] = "changed"
+    assert parse_message("  " + FULL.replace(", ", ",   ") + " ")["name"] == "Raju"